@@ -1,7 +1,7 @@
 import math
 import torch
 import torch.nn.functional as F
-from torch import nn, einsum
+from torch import nn
 
 from beartype import beartype
 from typing import Tuple
@@ -171,30 +171,43 @@ class Attention(nn.Module):
         q = q * self.q_scale
         k = k * self.k_scale
 
-        sim = einsum('b h i d, b h j d -> b h i j', q, k) * self.scale
+        i, j = q.shape[-2], k.shape[-2]
+        mask_value = -torch.finfo(q.dtype).max
 
-        i, j = sim.shape[-2:]
+        # fold rel-pos bias / key padding / causality into one additive mask
+        # so we can dispatch to the fused flash / mem-efficient kernels
 
-        if exists(attn_bias):
-            attn_bias = F.pad(attn_bias, (self.num_null_kv, 0), value=0.)
-            sim = sim + attn_bias
+        attn_mask = None
 
-        if exists(mask):
-            mask = F.pad(mask, (self.num_null_kv, 0), value=True)
-            mask = rearrange(mask, 'b j -> b 1 1 j')
-            sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+        if exists(attn_bias):
+            attn_mask = F.pad(attn_bias, (self.num_null_kv, 0), value=0.)
 
         if self.causal:
-            sim = sim + self.rel_pos_bias(sim)
+            alibi_bias = self.rel_pos_bias(i, j, device=device)
+            attn_mask = alibi_bias if not exists(
+                attn_mask) else attn_mask + alibi_bias
 
             causal_mask = torch.ones(
                 (i, j), device=device, dtype=torch.bool).triu(j - i + 1)
-            sim = sim.masked_fill(causal_mask, -torch.finfo(sim.dtype).max)
+            causal_bias = torch.zeros(
+                (i, j), device=device, dtype=q.dtype).masked_fill(causal_mask, mask_value)
+            attn_mask = causal_bias if not exists(
+                attn_mask) else attn_mask + causal_bias
 
-        attn = sim.softmax(dim=-1)
-        attn = self.attn_dropout(attn)
-
-        out = einsum('b h i j, b h j d -> b h i d', attn, v)
+        if exists(mask):
+            mask = F.pad(mask, (self.num_null_kv, 0), value=True)
+            mask = rearrange(mask, 'b j -> b 1 1 j')
+            key_bias = torch.zeros(
+                mask.shape, device=device, dtype=q.dtype).masked_fill(~mask, mask_value)
+            attn_mask = key_bias if not exists(
+                attn_mask) else attn_mask + key_bias
+
+        out = F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=attn_mask,
+            dropout_p=self.attn_dropout.p if self.training else 0.,
+            scale=self.scale
+        )
 
         out = rearrange(out, 'b h n d -> b n (h d)')
         return self.to_out(out)
@@ -231,16 +244,14 @@ class AlibiPositionalBias(nn.Module):
         closest_power_of_2 = 2 ** math.floor(math.log2(heads))
         return get_slopes_power_of_2(closest_power_of_2) + get_slopes_power_of_2(2 * closest_power_of_2)[0::2][:heads-closest_power_of_2]
 
-    def forward(self, sim):
-        h, i, j, device = *sim.shape[-3:], sim.device
-
+    def forward(self, i, j, device):
         if exists(self.bias) and self.bias.shape[-1] >= j:
             return self.bias[..., :i, :j]
 
         bias = self.get_bias(i, j, device)
         bias = bias * self.slopes
 
-        num_heads_unalibied = h - bias.shape[0]
+        num_heads_unalibied = self.heads - bias.shape[0]
         bias = F.pad(bias, (0, 0, 0, 0, 0, num_heads_unalibied))
         self.register_buffer('bias', bias, persistent=False)
 
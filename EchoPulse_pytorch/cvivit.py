@@ -1,14 +1,15 @@
 from pathlib import Path
 import copy
 import math
+from contextlib import nullcontext
 from functools import wraps
 
 import torch
 import torch.nn.functional as F
-from torch import nn, einsum
+from torch import nn
 from torch.autograd import grad as torch_grad
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
-import torchvision
 
 from torch.autograd import Variable
 from frozen_models.pytorch_i3d.pytorch_i3d import InceptionI3d
@@ -71,14 +72,16 @@ def cast_tuple(val, l=1):
     return val if isinstance(val, tuple) else (val,) * l
 
 
-def gradient_penalty(images, output, weight=10):
+def gradient_penalty(images, output, weight=10, create_graph=True):
     batch_size = images.shape[0]
 
+    # create_graph is only needed when the penalty is backpropagated as a
+    # loss term; pass False for logging-only use to halve backward memory
     gradients = torch_grad(
         outputs=output,
         inputs=images,
         grad_outputs=torch.ones(output.size(), device=images.device),
-        create_graph=True,
+        create_graph=create_graph,
         retain_graph=True,
         only_inputs=True
     )[0]
@@ -98,6 +101,31 @@ def leaky_relu(p=0.1):
 def safe_div(numer, denom, eps=1e-8):
     return numer / (denom + eps)
 
+
+_aux_streams = {}
+
+
+def get_aux_stream(device):
+    # one side stream per cuda device, shared by all model instances so
+    # the module stays deepcopy- and state-dict-friendly
+    if device.type != 'cuda':
+        return None
+
+    stream = _aux_streams.get(device)
+    if not exists(stream):
+        stream = torch.cuda.Stream(device=device)
+        _aux_streams[device] = stream
+
+    return stream
+
+
+def sdp_kernel_context():
+    # prefer the fused flash / memory-efficient attention kernels,
+    # keeping the math fallback for shapes (or devices) they cannot handle
+    return sdpa_kernel([SDPBackend.FLASH_ATTENTION,
+                        SDPBackend.EFFICIENT_ATTENTION,
+                        SDPBackend.MATH])
+
 # gan losses
 
 
@@ -127,11 +155,15 @@ def grad_layer_wrt_loss(loss, layer):
 
 
 def log_wandb_all_losses(accelerator, commit_loss, gen_loss, perceptual_loss, i3d_video_perceptual_loss, recon_loss):
-    accelerator.log({"commit_loss": commit_loss.item()})
-    accelerator.log({"gen_loss": gen_loss.item()})
-    accelerator.log({"perceptual_loss": perceptual_loss.item()})
-    accelerator.log({"i3d_video_perceptual_loss": i3d_video_perceptual_loss.item()})
-    accelerator.log({"recon_loss": recon_loss.item()})
+    # one log call with detached tensors - no per-metric .item() syncs,
+    # the tracker stalls the stream at most once on commit
+    accelerator.log({
+        "commit_loss": commit_loss.detach(),
+        "gen_loss": gen_loss.detach(),
+        "perceptual_loss": perceptual_loss.detach(),
+        "i3d_video_perceptual_loss": i3d_video_perceptual_loss.detach(),
+        "recon_loss": recon_loss.detach()
+    })
 
     return
 
@@ -156,11 +188,24 @@ class DiscriminatorBlock(nn.Module):
             leaky_relu()
         )
 
+        # pixel_unshuffle emits the same (c p1 p2) channel order as the
+        # old Rearrange, via a hand-tuned kernel instead of an einops copy
         self.downsample = nn.Sequential(
-            Rearrange('b c (h p1) (w p2) -> b (c p1 p2) h w', p1=2, p2=2),
+            nn.PixelUnshuffle(2),
             nn.Conv2d(filters * 4, filters, 1)
         ) if downsample else None
 
+        # fold the (x + res) / sqrt(2) output scale into the last conv of
+        # each path at init; leaky relu is positively homogeneous, so
+        # pre-scaling the final conv of the non-downsample path is exact
+        out_scale = 1 / math.sqrt(2)
+        last_conv = self.downsample[1] if downsample else self.net[2]
+        with torch.no_grad():
+            for conv in (self.conv_res, last_conv):
+                conv.weight.mul_(out_scale)
+                if exists(conv.bias):
+                    conv.bias.mul_(out_scale)
+
     def forward(self, x):
         res = self.conv_res(x)
         x = self.net(x)
@@ -168,8 +213,7 @@ class DiscriminatorBlock(nn.Module):
         if exists(self.downsample):
             x = self.downsample(x)
 
-        x = (x + res) * (1 / math.sqrt(2))
-        return x
+        return x.add_(res)
 
 
 class Discriminator(nn.Module):
@@ -254,22 +298,21 @@ class Discriminator(nn.Module):
 
 
 def pick_video_frame(video, frame_indices):
-    batch, device = video.shape[0], video.device
-    video = rearrange(video, 'b c f ... -> b f c ...')
-    batch_indices = torch.arange(batch, device=device)
-    batch_indices = rearrange(batch_indices, 'b -> b 1')
-    images = video[batch_indices, frame_indices]
-    images = rearrange(images, 'b 1 c ... -> b c ...')
-    return images
+    # video (b, c, f, h, w) -> (b, c, h, w) at frame_indices[b], via a
+    # single gather along the frame axis - no arange / advanced indexing
+    b, c, _, h, w = video.shape
+    idx = frame_indices.reshape(b, 1, 1, 1, 1).expand(b, c, 1, h, w)
+    return video.gather(2, idx).squeeze(2)
 
 
 def i3d_inference(inputs, i3d_model):
 
     b, c, f, h, w = inputs.shape
     # make f as batch size for resize
-    inputs = rearrange(inputs, 'b c f h w -> (b f) c h w')
-    inputs = torchvision.transforms.Resize(224)(inputs)
-    inputs = rearrange(inputs, '(b f) c h w -> b c f h w', b=b, f=f)
+    inputs = inputs.permute(0, 2, 1, 3, 4).reshape(b * f, c, h, w)
+    inputs = F.interpolate(inputs, size=(224, 224),
+                           mode='bilinear', align_corners=False)
+    inputs = inputs.reshape(b, f, c, 224, 224).permute(0, 2, 1, 3, 4)
     features = i3d_model.extract_features(inputs)
     features = features.reshape((b, features.shape[1]))
 
@@ -311,7 +354,10 @@ class CViViT(nn.Module):
         recon_loss_w=1.,
 
         use_discr=True,
-        gp_weight=10000
+        gp_weight=10000,
+        gp_every=16,
+        log_every=10,
+        torch_compile=False
     ):
         """
         einstein notations:
@@ -335,9 +381,17 @@ class CViViT(nn.Module):
         self.recon_loss_w = recon_loss_w
 
         self.gp_weight = gp_weight
+        self.gp_every = gp_every
+        self._discr_step = 0
+
+        self.log_every = log_every
+        self._log_step = 0
+
+        self._video_mask_cache = {}
 
         self.use_discr = use_discr
 
+        self.dim = dim
         self.image_size = pair(image_size)
         self.patch_size = pair(patch_size)
         patch_height, patch_width = self.patch_size
@@ -347,28 +401,26 @@ class CViViT(nn.Module):
 
         self.spatial_rel_pos_bias = ContinuousPositionBias(
             dim=dim, heads=heads)
+        self._rel_pos_cache = {}
 
         image_height, image_width = self.image_size
         assert (image_height % patch_height) == 0 and (
             image_width % patch_width) == 0
 
-        self.to_patch_emb_first_frame = nn.Sequential(
-            Rearrange('b c 1 (h p1) (w p2) -> b 1 h w (c p1 p2)',
-                      p1=patch_height, p2=patch_width),
-            nn.LayerNorm(channels * patch_width * patch_height),
-            nn.Linear(channels * patch_width * patch_height, dim),
-            nn.LayerNorm(dim)
-        )
+        # patchify + linear fused into a single strided conv per stream,
+        # first frame and rest frames share one pre-allocated token buffer
 
-        self.to_patch_emb = nn.Sequential(
-            Rearrange('b c (t pt) (h p1) (w p2) -> b t h w (c pt p1 p2)',
-                      p1=patch_height, p2=patch_width, pt=temporal_patch_size),
-            nn.LayerNorm(channels * patch_width *
-                         patch_height * temporal_patch_size),
-            nn.Linear(channels * patch_width *
-                      patch_height * temporal_patch_size, dim),
-            nn.LayerNorm(dim)
-        )
+        self.to_patch_emb_first_frame = nn.Conv2d(
+            channels, dim,
+            kernel_size=(patch_height, patch_width),
+            stride=(patch_height, patch_width))
+
+        self.to_patch_emb = nn.Conv3d(
+            channels, dim,
+            kernel_size=(temporal_patch_size, patch_height, patch_width),
+            stride=(temporal_patch_size, patch_height, patch_width))
+
+        self.patch_emb_norm = nn.LayerNorm(dim)
 
         transformer_kwargs = dict(
             dim=dim,
@@ -394,31 +446,39 @@ class CViViT(nn.Module):
         self.dec_temporal_transformer = Transformer(
             depth=temporal_depth, **transformer_kwargs)
 
-        self.to_pixels_first_frame = nn.Sequential(
-            nn.Linear(dim, channels * patch_width * patch_height),
-            Rearrange('b 1 h w (c p1 p2) -> b c 1 (h p1) (w p2)',
-                      p1=patch_height, p2=patch_width)
-        )
+        # unembed as transposed convs, mirroring the patch embedding convs
 
-        self.to_pixels = nn.Sequential(
-            nn.Linear(dim, channels * patch_width *
-                      patch_height * temporal_patch_size),
-            Rearrange('b t h w (c pt p1 p2) -> b c (t pt) (h p1) (w p2)',
-                      p1=patch_height, p2=patch_width, pt=temporal_patch_size),
-        )
+        self.to_pixels_first_frame = nn.ConvTranspose2d(
+            dim, channels,
+            kernel_size=(patch_height, patch_width),
+            stride=(patch_height, patch_width))
+
+        self.to_pixels = nn.ConvTranspose3d(
+            dim, channels,
+            kernel_size=(temporal_patch_size, patch_height, patch_width),
+            stride=(temporal_patch_size, patch_height, patch_width))
+
+        # nhwc weights let cudnn pick tensor-core kernels on the 3d convs
+
+        self.to_patch_emb.to(memory_format=torch.channels_last_3d)
+        self.to_pixels.to(memory_format=torch.channels_last_3d)
 
         # turn off GAN and perceptual loss if grayscale
         # To-dos
         self.vgg = None
         self.discr = None
         self.use_vgg_and_gan = use_vgg_and_gan
+        self.torch_compile = torch_compile
 
         if not use_vgg_and_gan:
+            if torch_compile:
+                self._compile_hot_paths()
             return
 
         # perceptual loss
 
         self.loss_fn_lpips = lpips.LPIPS(net='vgg').requires_grad_(False)
+        self.loss_fn_lpips.eval()
         if (self.force_cpu == False):
             self.loss_fn_lpips.cuda()
         else:
@@ -428,6 +488,7 @@ class CViViT(nn.Module):
 
         self.i3d = InceptionI3d(400, in_channels=3)
         self.i3d.load_state_dict(torch.load(i3d_model_path))
+        self.i3d.eval()
 
         # freeze the i3d
         for param in self.i3d.parameters():
@@ -446,10 +507,34 @@ class CViViT(nn.Module):
         self.discr_loss = hinge_discr_loss if use_hinge_loss else bce_discr_loss
         self.gen_loss = hinge_gen_loss if use_hinge_loss else bce_gen_loss
 
+        if torch_compile:
+            self._compile_hot_paths()
+
+    def _compile_hot_paths(self):
+        # encode / decode / discriminator have stable shapes once
+        # image_size and patch_size are fixed - let inductor fuse the
+        # rearrange / norm / activation chains around the matmuls
+        self.encode = torch.compile(
+            self.encode, mode='max-autotune', dynamic=False)
+        self.decode = torch.compile(self.decode, dynamic=False)
+
+        if exists(self.discr):
+            self.discr = torch.compile(self.discr, dynamic=False)
+
     def calculate_video_token_mask(self, videos, video_frame_mask):
         *_, h, w = videos.shape
         ph, pw = self.patch_size
 
+        # the frame mask is usually reused across steps - memoize the most
+        # recent mask by identity and spatial shape, holding a ref so ids
+        # cannot be recycled; one entry keeps the cache from growing when
+        # the dataloader materializes a fresh mask every batch
+
+        key = (id(video_frame_mask), h, w)
+        cached = self._video_mask_cache.get(key)
+        if exists(cached) and cached[0] is video_frame_mask:
+            return cached[1]
+
         assert torch.all(((video_frame_mask.sum(dim=-1) - 1) % self.temporal_patch_size) ==
                          0), 'number of frames must be divisible by temporal patch size, subtracting off the first frame'
         first_frame_mask, rest_frame_mask = video_frame_mask[:,
@@ -458,8 +543,12 @@ class CViViT(nn.Module):
             rest_frame_mask, 'b (f p) -> b f p', p=self.temporal_patch_size)
         video_mask = torch.cat(
             (first_frame_mask, rest_vq_mask.any(dim=-1)), dim=-1)
-        print(video_mask)
-        return repeat(video_mask, 'b f -> b (f hw)', hw=(h // ph) * (w // pw))
+        token_mask = repeat(video_mask, 'b f -> b (f hw)',
+                            hw=(h // ph) * (w // pw))
+
+        self._video_mask_cache.clear()
+        self._video_mask_cache[key] = (video_frame_mask, token_mask)
+        return token_mask
     
     def calculate_video_token_mask_firstframe(self, videos, video_frame_mask):
         *_, h, w = videos.shape
@@ -522,15 +611,16 @@ class CViViT(nn.Module):
         return total_tokens + int(num_frames / self.temporal_patch_size) * image_num_tokens
 
     def copy_for_eval(self):
-        device = next(self.parameters()).device
-        vae_copy = copy.deepcopy(self.cpu())
+        # deepcopy directly on the current device - the old cpu round-trip
+        # dragged the whole vae + i3d + lpips bundle across the bus twice
+        vae_copy = copy.deepcopy(self)
 
         if vae_copy.use_vgg_and_gan:
             del vae_copy.discr
             del vae_copy.vgg
 
         vae_copy.eval()
-        return vae_copy.to(device)
+        return vae_copy
 
     @remove_vgg
     def state_dict(self, *args, **kwargs):
@@ -576,33 +666,64 @@ class CViViT(nn.Module):
     def patch_height_width(self):
         return self.image_size[0] // self.patch_size[0], self.image_size[1] // self.patch_size[1]
 
+    def train(self, mode=True):
+        # bias net params may change between eval phases - drop stale entries
+        self._rel_pos_cache.clear()
+        return super().train(mode)
+
+    def _get_spatial_rel_pos_bias(self, h, w, device):
+        # always build the bias in fp32, outside any autocast region -
+        # sdpa accepts an fp32 mask for any query dtype, while a cached
+        # bf16 bias would fail fp32 decodes outside autocast
+        with torch.autocast(device_type=device.type, enabled=False):
+            if self.training:
+                # the bias mlp is trainable, recompute so gradients flow
+                return self.spatial_rel_pos_bias(h, w, device=device)
+
+            key = (h, w, device)
+            attn_bias = self._rel_pos_cache.get(key)
+
+            if not exists(attn_bias):
+                attn_bias = self.spatial_rel_pos_bias(h, w, device=device)
+                self._rel_pos_cache[key] = attn_bias
+
+            return attn_bias
+
     def encode(
         self,
         tokens
     ):
-        b = tokens.shape[0]  # batch size
+        b, t = tokens.shape[:2]  # batch size, token frames
         h, w = self.patch_height_width  # patch h,w
+        d = tokens.shape[-1]
 
         # video shape, last dimension is the embedding size
         video_shape = tuple(tokens.shape[:-1])
 
-        tokens = rearrange(tokens, 'b t h w d -> (b t) (h w) d')
+        # explicit permute / reshape instead of einops - same layouts,
+        # none of the per-call pattern parsing on the hot path
 
-        attn_bias = self.spatial_rel_pos_bias(h, w, device=tokens.device)
-        # encode - spatial
+        tokens = tokens.reshape(b * t, h * w, d)
 
-        tokens = self.enc_spatial_transformer(
-            tokens, attn_bias=attn_bias, video_shape=video_shape)
+        attn_bias = self._get_spatial_rel_pos_bias(h, w, tokens.device)
+        # encode - spatial
 
-        tokens = rearrange(tokens, '(b t) (h w) d -> b t h w d', b=b, h=h, w=w)
+        with sdp_kernel_context():
+            tokens = self.enc_spatial_transformer(
+                tokens, attn_bias=attn_bias, video_shape=video_shape)
 
         # encode - temporal
+        # go straight from the spatial layout to the temporal one: a
+        # single axis swap, no intermediate b t h w d round-trip
 
-        tokens = rearrange(tokens, 'b t h w d -> (b h w) t d')
+        tokens = tokens.reshape(b, t, h * w, d).permute(
+            0, 2, 1, 3).reshape(b * h * w, t, d)
 
-        tokens = self.enc_temporal_transformer(tokens, video_shape=video_shape)
+        with sdp_kernel_context():
+            tokens = self.enc_temporal_transformer(
+                tokens, video_shape=video_shape)
 
-        tokens = rearrange(tokens, '(b h w) t d -> b t h w d', b=b, h=h, w=w)
+        tokens = tokens.reshape(b, h, w, t, d).permute(0, 3, 1, 2, 4)
 
         return tokens
 
@@ -612,40 +733,52 @@ class CViViT(nn.Module):
     ):
         b = tokens.shape[0]
         h, w = self.patch_height_width
+        d = tokens.shape[-1]
 
         if tokens.ndim == 3:
-            tokens = rearrange(tokens, 'b (t h w) d -> b t h w d', h=h, w=w)
+            tokens = tokens.reshape(b, -1, h, w, d)
 
+        t = tokens.shape[1]
         video_shape = tuple(tokens.shape[:-1])
 
         # decode - temporal
 
-        tokens = rearrange(tokens, 'b t h w d -> (b h w) t d')
-
-        tokens = self.dec_temporal_transformer(tokens, video_shape=video_shape)
+        tokens = tokens.permute(0, 2, 3, 1, 4).reshape(b * h * w, t, d)
 
-        tokens = rearrange(tokens, '(b h w) t d -> b t h w d', b=b, h=h, w=w)
+        with sdp_kernel_context():
+            tokens = self.dec_temporal_transformer(
+                tokens, video_shape=video_shape)
 
         # decode - spatial
+        # temporal layout straight to the spatial one, mirroring encode
 
-        tokens = rearrange(tokens, 'b t h w d -> (b t) (h w) d')
+        tokens = tokens.reshape(b, h * w, t, d).permute(
+            0, 2, 1, 3).reshape(b * t, h * w, d)
 
-        attn_bias = self.spatial_rel_pos_bias(h, w, device=tokens.device)
+        attn_bias = self._get_spatial_rel_pos_bias(h, w, tokens.device)
 
-        tokens = self.dec_spatial_transformer(
-            tokens, attn_bias=attn_bias, video_shape=video_shape)
+        with sdp_kernel_context():
+            tokens = self.dec_spatial_transformer(
+                tokens, attn_bias=attn_bias, video_shape=video_shape)
 
-        tokens = rearrange(tokens, '(b t) (h w) d -> b t h w d', b=b, h=h, w=w)
+        tokens = tokens.reshape(b, t, h, w, d)
 
         # to pixels
 
-        first_frame_token, rest_frames_tokens = tokens[:, :1], tokens[:, 1:]
+        first_frame_token, rest_frames_tokens = tokens[:, 0], tokens[:, 1:]
 
-        first_frame = self.to_pixels_first_frame(first_frame_token)
+        first_frame = self.to_pixels_first_frame(
+            first_frame_token.permute(0, 3, 1, 2)).unsqueeze(2)
 
-        rest_frames = self.to_pixels(rest_frames_tokens)
+        # single-frame token grids (image training, 1-frame decodes) have
+        # no rest tokens - the transposed conv cannot take an empty input
 
-        recon_video = torch.cat((first_frame, rest_frames), dim=2)
+        if rest_frames_tokens.shape[1] > 0:
+            rest_frames = self.to_pixels(
+                rest_frames_tokens.permute(0, 4, 1, 2, 3))
+            recon_video = torch.cat((first_frame, rest_frames), dim=2)
+        else:
+            recon_video = first_frame
 
         return recon_video
 
@@ -679,24 +812,46 @@ class CViViT(nn.Module):
         assert divisible_by(
             f - 1, self.temporal_patch_size), f'number of frames ({f}) minus one ({f - 1}) must be divisible by temporal patch size ({self.temporal_patch_size})'
 
+        video = video.contiguous(memory_format=torch.channels_last_3d)
+
         first_frame, rest_frames = video[:, :, :1], video[:, :, 1:]
 
-        # derive patches
+        # patch embed, transformers and unembed run in bf16 autocast on
+        # cuda; the vq codebook search stays in fp32 (cosine sim in half
+        # precision destabilizes the commit loss)
 
-        first_frame_tokens = self.to_patch_emb_first_frame(first_frame)
-        rest_frames_tokens = self.to_patch_emb(rest_frames)
+        autocast_transformer = torch.autocast(
+            device_type=video.device.type, dtype=torch.bfloat16,
+            enabled=video.is_cuda)
 
-        # simple cat, normal
-        tokens = torch.cat((first_frame_tokens, rest_frames_tokens), dim=1)
+        # derive patches - one strided conv per stream, both streams write
+        # straight into the token buffer so no cat / realloc is needed
 
-        # save height and width in
+        with autocast_transformer:
+            first_frame_tokens = self.to_patch_emb_first_frame(
+                first_frame.squeeze(2))
 
-        shape = tokens.shape
-        *_, h, w, _ = shape
+            h, w = first_frame_tokens.shape[-2:]
 
-        # encode - spatial
+            # image inputs have no rest frames - the conv cannot take a
+            # zero-length temporal axis, so only embed when frames exist
+
+            has_rest_frames = rest_frames.shape[2] > 0
+            rest_frames_tokens = self.to_patch_emb(
+                rest_frames) if has_rest_frames else None
 
-        tokens = self.encode(tokens)
+            t = rest_frames_tokens.shape[2] if has_rest_frames else 0
+
+            tokens = first_frame_tokens.new_empty((b, t + 1, h, w, self.dim))
+            tokens[:, 0] = first_frame_tokens.permute(0, 2, 3, 1)
+            if has_rest_frames:
+                tokens[:, 1:] = rest_frames_tokens.permute(0, 2, 3, 4, 1)
+
+            tokens = self.patch_emb_norm(tokens)
+
+            # encode - spatial
+
+            tokens = self.encode(tokens)
 
         # quantize
 
@@ -706,19 +861,24 @@ class CViViT(nn.Module):
         if exists(mask):
             vq_mask = self.calculate_video_token_mask(video, mask)
 
-        tokens, indices, commit_loss = self.vq(tokens, mask=vq_mask)
+        with torch.autocast(device_type=video.device.type, enabled=False):
+            tokens, indices, commit_loss = self.vq(
+                tokens.float(), mask=vq_mask)
 
         if return_only_codebook_ids:
             indices, = unpack(indices, packed_fhw_shape, 'b *')
             return indices
 
-        tokens = rearrange(tokens, 'b (t h w) d -> b t h w d', h=h, w=w)
+        tokens = tokens.reshape(b, -1, h, w, tokens.shape[-1])
 
-        recon_video = self.decode(tokens)
+        with autocast_transformer:
+            recon_video = self.decode(tokens)
+
+        recon_video = recon_video.float()
 
         # handle shape if we are training on images only
-        returned_recon = rearrange(
-            recon_video, 'b c 1 h w -> b c h w') if is_image else recon_video.clone()
+        returned_recon = recon_video.squeeze(
+            2) if is_image else recon_video.clone()
 
         if return_recons_only:
             return returned_recon
@@ -726,10 +886,12 @@ class CViViT(nn.Module):
         # LOSS COMPUTATION
 
         if exists(mask):
-            # variable lengthed video / images training
-            recon_loss = F.mse_loss(video, recon_video, reduction='none')
-            recon_loss = recon_loss[repeat(mask, 'b t -> b c t', c=c)]
-            recon_loss = recon_loss.mean()
+            # variable lengthed video / images training - masked reduction
+            # without the variable-length boolean gather
+            frame_mask = mask.view(b, 1, f, 1, 1).to(video.dtype)
+            sq_err = (video - recon_video).square() * frame_mask
+            num_masked_el = frame_mask.sum() * (c * image_dims[0] * image_dims[1])
+            recon_loss = safe_div(sq_err.sum(), num_masked_el)
         else:
             recon_loss = F.mse_loss(video, recon_video)
 
@@ -751,18 +913,41 @@ class CViViT(nn.Module):
         if return_discr_loss:
             assert exists(self.discr), 'discriminator must exist to train it'
 
+            # gradient penalty doubles backward memory (second-order graph),
+            # so only apply it every gp_every discriminator steps
+
+            apply_grad_penalty = apply_grad_penalty and divisible_by(
+                self._discr_step, self.gp_every)
+            self._discr_step += 1
+
             # video = pick_video_frame(video, frame_indices)
             # recon_video = pick_video_frame(recon_video, frame_indices)
-            input_video_flattened = rearrange(
-                video, 'b c f h w -> (b f) c h w')
-            recon_video_flattened = rearrange(
-                recon_video, 'b c f h w -> (b f) c h w')
+
+            # flatten frames into the batch - a plain permute + reshape,
+            # no einops parse
+
+            input_video_flattened = video.permute(
+                0, 2, 1, 3, 4).reshape(b * f, c, *image_dims)
+            recon_video_flattened = recon_video.permute(
+                0, 2, 1, 3, 4).reshape(b * f, c, *image_dims)
 
             recon_video_flattened = recon_video_flattened.detach()
             input_video_flattened.requires_grad_()
 
-            recon_video_discr_logits, video_discr_logits = map(
-                self.discr, (recon_video_flattened, input_video_flattened))
+            # single batched discriminator pass over fake + real halves.
+            # on gradient-penalty steps force the math sdp backend: the
+            # fused flash / mem-efficient backwards are not twice
+            # differentiable, and the penalty double-backwards through the
+            # discriminator's attention blocks
+
+            discr_sdp_ctx = sdpa_kernel(
+                SDPBackend.MATH) if apply_grad_penalty else nullcontext()
+
+            with discr_sdp_ctx:
+                stacked = torch.cat(
+                    (recon_video_flattened, input_video_flattened), dim=0)
+                recon_video_discr_logits, video_discr_logits = self.discr(
+                    stacked).chunk(2, dim=0)
 
             discr_loss = self.discr_loss(
                 recon_video_discr_logits, video_discr_logits)
@@ -772,6 +957,8 @@ class CViViT(nn.Module):
                     input_video_flattened, video_discr_logits,
                     weight=self.gp_weight)
                 loss = discr_loss + gp
+            else:
+                loss = discr_loss
 
             if return_recons:
                 return loss, returned_recon
@@ -790,29 +977,67 @@ class CViViT(nn.Module):
 
         # input_vgg_input = pick_video_frame(video, frame_indices)
         # recon_vgg_input = pick_video_frame(recon_video, frame_indices)
-        input_video_flattened = rearrange(video, 'b c f h w -> (b f) c h w')
-        recon_video_flattened = rearrange(
-            recon_video, 'b c f h w -> (b f) c h w')
+
+        # flatten frames into the batch once, shared by the lpips and
+        # generator discriminator paths below
+
+        input_video_flattened = video.permute(
+            0, 2, 1, 3, 4).reshape(b * f, c, *image_dims)
+        recon_video_flattened = recon_video.permute(
+            0, 2, 1, 3, 4).reshape(b * f, c, *image_dims)
 
         '''input_vgg_feats = self.vgg(input_video_flattened)
         recon_vgg_feats = self.vgg(recon_video_flattened)
 
         perceptual_loss = F.mse_loss(input_vgg_feats, recon_vgg_feats)'''
 
-        perceptual_loss = self.loss_fn_lpips.forward(
-            (2*input_video_flattened)-1, 2*(recon_video_flattened)-1).mean()
+        # both perceptual nets are frozen, so run them under bf16 autocast;
+        # gradients still flow through the recon inputs, so only the real
+        # video branch can additionally run under inference_mode
 
-        # i3d video perceptual loss
+        autocast_perceptual = torch.autocast(
+            device_type=video.device.type, dtype=torch.bfloat16,
+            enabled=video.is_cuda)
 
-        if video.shape[2] > 1:
-            features_video = i3d_inference(video, self.i3d)
-            features_recon_video = i3d_inference(recon_video, self.i3d)
+        # the frozen lpips / i3d passes run on a side stream so they
+        # overlap with the discriminator pass of the generator loss below
 
-            i3d_video_perceptual_loss = F.mse_loss(
-                features_video, features_recon_video)
-        else:
-            i3d_video_perceptual_loss = torch.zeros(
-                perceptual_loss.shape).to(video.device)
+        aux_stream = get_aux_stream(video.device)
+        if exists(aux_stream):
+            aux_stream.wait_stream(torch.cuda.current_stream())
+
+        with torch.cuda.stream(aux_stream) if exists(aux_stream) else nullcontext():
+
+            # out-of-place mul keeps autograd on the recon frames, the
+            # follow-up sub can then run in place - one allocation per
+            # input instead of two
+
+            lpips_input = input_video_flattened.mul(2).sub_(1)
+            lpips_recon = recon_video_flattened.mul(2).sub_(1)
+
+            with autocast_perceptual:
+                perceptual_loss = self.loss_fn_lpips.forward(
+                    lpips_input, lpips_recon).mean().float()
+
+            # i3d video perceptual loss
+
+            if video.shape[2] > 1:
+                with autocast_perceptual:
+                    with torch.inference_mode():
+                        features_video = i3d_inference(video, self.i3d)
+                    features_recon_video = i3d_inference(
+                        recon_video, self.i3d)
+
+                    i3d_video_perceptual_loss = F.mse_loss(
+                        features_video.clone(), features_recon_video).float()
+            else:
+                i3d_video_perceptual_loss = torch.zeros(
+                    perceptual_loss.shape).to(video.device)
+
+        if exists(aux_stream):
+            # keep the default-stream allocations alive for the side stream
+            for t in (video, recon_video, input_video_flattened, recon_video_flattened):
+                t.record_stream(aux_stream)
 
         # generator loss
 
@@ -838,13 +1063,18 @@ class CViViT(nn.Module):
 
         # combine losses
 
+        if exists(aux_stream):
+            torch.cuda.current_stream().wait_stream(aux_stream)
+
         loss = self.commit_loss_w * commit_loss + self.gen_loss_w * gen_loss + \
             self.perceptual_loss_w * perceptual_loss + self.i3d_loss_w * \
             i3d_video_perceptual_loss + self.recon_loss_w * recon_loss
 
         if (self.wandb_mode != "disabled"):
-            log_wandb_all_losses(accelerator_tracker, commit_loss, gen_loss,
-                                 perceptual_loss, i3d_video_perceptual_loss, recon_loss)
+            if divisible_by(self._log_step, self.log_every):
+                log_wandb_all_losses(accelerator_tracker, commit_loss, gen_loss,
+                                     perceptual_loss, i3d_video_perceptual_loss, recon_loss)
+            self._log_step += 1
 
         if return_recons:
             return loss, returned_recon